@@ -1,9 +1,18 @@
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
 from lifetimes import BetaGeoFitter
 from lifetimes import GammaGammaFitter
 import warnings
 
 warnings.filterwarnings("ignore")
+pd.set_option("mode.copy_on_write", True)
+
+DATE_COLS = ("first_order_date", "last_order_date", "last_order_date_online", "last_order_date_offline")
+
+# last fitted BG/NBD log-params per penalizer coefficient
+_bgf_warm_start = {}
 
 
 def grab_col_names(dataframe, cat_th=10, car_th=20):
@@ -25,33 +34,30 @@ def grab_col_names(dataframe, cat_th=10, car_th=20):
         Tuple containing lists of categorical columns, categorical but cardinal columns, and numerical columns.
 
     """
-    cat_cols = [col for col in dataframe.columns if dataframe[col].dtypes == "O"]
+    object_nunique = dataframe.select_dtypes(include="object").nunique()
+    other_nunique = dataframe.select_dtypes(exclude="object").nunique()
 
-    num_but_cat = [col for col in dataframe.columns if dataframe[col].nunique() < cat_th and
-                   dataframe[col].dtypes != "O"]
+    num_but_cat = other_nunique.index[other_nunique < cat_th].tolist()
 
-    cat_but_car = [col for col in dataframe.columns if dataframe[col].nunique() > car_th and
-                   dataframe[col].dtypes == "O"]
+    cat_but_car = object_nunique.index[object_nunique > car_th].tolist()
 
-    cat_cols = cat_cols + num_but_cat
-    cat_cols = [col for col in cat_cols if col not in cat_but_car]
+    cat_cols = object_nunique.index[object_nunique <= car_th].tolist() + num_but_cat
 
-    num_cols = [col for col in dataframe.columns if dataframe[col].dtypes != "O"]
-    num_cols = [col for col in num_cols if col not in num_but_cat]
+    num_cols = other_nunique.index[other_nunique >= cat_th].tolist()
 
     return cat_cols, cat_but_car, num_cols
 
 
-def outlier_thresholds(dataframe, column, low_quantile=0.01, up_quantile=0.99):
+def outlier_thresholds_batch(dataframe, columns, low_quantile=0.01, up_quantile=0.99):
     """
-    Calculates the lower and upper outlier thresholds for a given column.
+    Calculates the lower and upper outlier thresholds for several columns with a single quantile call.
 
     Parameters
     ----------
     dataframe : pd.DataFrame
         The input DataFrame.
-    column : str
-        The column name for which to calculate thresholds.
+    columns : list
+        The column names for which to calculate thresholds.
     low_quantile : float, optional
         The lower quantile for threshold calculation, default is 0.01.
     up_quantile : float, optional
@@ -60,38 +66,16 @@ def outlier_thresholds(dataframe, column, low_quantile=0.01, up_quantile=0.99):
     Returns
     -------
     tuple
-        Tuple containing the lower and upper thresholds.
+        Tuple containing arrays of the lower and upper thresholds, aligned with `columns`.
 
     """
-    quantile1 = dataframe[column].quantile(low_quantile)
-    quantile3 = dataframe[column].quantile(up_quantile)
-    interquantile_range = quantile3 - quantile1
-    up_limit = quantile3 + 1.5 * interquantile_range
-    low_limit = quantile1 - 1.5 * interquantile_range
+    quantiles = dataframe[columns].quantile([low_quantile, up_quantile]).values
+    interquantile_range = quantiles[1] - quantiles[0]
+    up_limit = quantiles[1] + 1.5 * interquantile_range
+    low_limit = quantiles[0] - 1.5 * interquantile_range
     return low_limit, up_limit
 
 
-def replace_with_thresholds(dataframe, column):
-    """
-     Replaces values outside the specified thresholds with rounded threshold values.
-
-    Parameters
-    ----------
-    dataframe : pd.Dataframe
-        The input DataFrame.
-    column : str
-        The column name for threshold replacement.
-
-    Returns
-    -------
-    None
-
-    """
-    low_limit, up_limit = outlier_thresholds(dataframe, column)
-    dataframe.loc[(dataframe[column] < low_limit), column] = round(low_limit, 0)
-    dataframe.loc[(dataframe[column] > up_limit), column] = round(up_limit, 0)
-
-
 def data_prep(dataframe):
     """
     Prepares the data by handling outliers and creating additional features.
@@ -99,7 +83,7 @@ def data_prep(dataframe):
     Parameters
     ----------
     dataframe : pd.DataFrame
-        The input DataFrame.
+        The input DataFrame, with date columns already parsed by `load_data`.
 
     Returns
     -------
@@ -107,16 +91,16 @@ def data_prep(dataframe):
         The prepared DataFrame.
 
     """
-    _, _, numeric = grab_col_names(dataframe)
-    for col in numeric:
-        replace_with_thresholds(dataframe, col)
-
-    dataframe["total_order_num"] = dataframe["order_num_total_ever_online"] + dataframe["order_num_total_ever_offline"]
-    dataframe["customer_value_total"] = dataframe["customer_value_total_ever_offline"] + dataframe[
-        "customer_value_total_ever_online"]
-
-    date_cols = dataframe.columns[dataframe.columns.str.contains("date")]
-    dataframe[date_cols] = dataframe[date_cols].apply(pd.to_datetime)
+    _, _, numeric = grab_col_names(dataframe.select_dtypes(exclude="datetime"))
+    low_limit, up_limit = outlier_thresholds_batch(dataframe, numeric)
+    values = dataframe[numeric].to_numpy(dtype=np.float64, copy=True)
+    np.clip(values, np.round(low_limit, 0), np.round(up_limit, 0), out=values)
+    dataframe[numeric] = values
+
+    dataframe.eval("""
+    total_order_num = order_num_total_ever_online + order_num_total_ever_offline
+    customer_value_total = customer_value_total_ever_offline + customer_value_total_ever_online
+    """, engine="numexpr", inplace=True)
     return dataframe
 
 
@@ -139,20 +123,67 @@ def create_cltv(dataframe):
     last_date = dataframe["last_order_date"].max()
     analysis_date = last_date + pd.Timedelta(days=2)
 
-    cltv = pd.DataFrame()
-    cltv["customer_id"] = df["master_id"]
-    cltv["recency_cltv_weekly"] = (df["last_order_date"] - df["first_order_date"]).dt.days / 7
-    cltv["T_weekly"] = (analysis_date - df["first_order_date"]).dt.days / 7
-    cltv["frequency"] = df["total_order_num"]
-    cltv["monetary_cltv_avg"] = df["customer_value_total"] / cltv["frequency"]
+    first_order = dataframe["first_order_date"].to_numpy("datetime64[ns]").view("i8")
+    last_order = dataframe["last_order_date"].to_numpy("datetime64[ns]").view("i8")
+    ns_per_week = 7 * 86400 * 10 ** 9
+
+    cltv = pd.DataFrame({"customer_id": dataframe["master_id"],
+                         "recency_cltv_weekly": (last_order - first_order) / ns_per_week,
+                         "T_weekly": (analysis_date.value - first_order) / ns_per_week,
+                         "frequency": dataframe["total_order_num"],
+                         "monetary_cltv_avg": dataframe["customer_value_total"] / dataframe["total_order_num"]},
+                        index=dataframe.index)
 
     return cltv
 
 
+def customer_lifetime_value(bgf, ggf, frequency, recency, T, monetary, time=6, discount_rate=0.01):
+    """
+    Calculates discounted CLTV for all customers and periods at once, equivalent to
+    `GammaGammaFitter.customer_lifetime_value` with weekly data.
+
+    Parameters
+    ----------
+    bgf : BetaGeoFitter
+        Fitted model predicting the number of transactions.
+    ggf : GammaGammaFitter
+        Fitted model predicting the average transaction value.
+    frequency : np.ndarray
+        Frequency of each customer.
+    recency : np.ndarray
+        Weekly recency of each customer.
+    T : np.ndarray
+        Weekly age of each customer.
+    monetary : np.ndarray
+        Average transaction value of each customer.
+    time : int, optional
+        The number of months for CLTV prediction, default is 6.
+    discount_rate : float, optional
+        Monthly discount rate, default is 0.01.
+
+    Returns
+    -------
+    np.ndarray
+        CLTV of each customer.
+
+    """
+    months = np.arange(time + 1)
+    weeks = (months * 4.345)[:, None]
+    expected_purchases = bgf.conditional_expected_number_of_purchases_up_to_time(weeks, frequency[None, :],
+                                                                                 recency[None, :], T[None, :])
+    monthly_purchases = np.diff(expected_purchases, axis=0)
+    discount = (1 + discount_rate) ** months[1:, None]
+    adjusted_monetary = ggf.conditional_expected_average_profit(frequency, monetary)
+    return adjusted_monetary * (monthly_purchases / discount).sum(axis=0)
+
+
 def modelling(dataframe, month=6):
     """
     Performs CLTV modeling using BetaGeoFitter and GammaGammaFitter.
 
+    The first BetaGeoFitter fit cold-starts with lifetimes' default BFGS minimization, later calls are
+    warm-started from the parameters of the previous fit.
+
     Parameters
     ----------
     dataframe : pd.DataFrame
@@ -166,30 +197,40 @@ def modelling(dataframe, month=6):
         DataFrame containing CLTV model predictions for the specified number of months.
     """
     dataframe = create_cltv(dataframe)
-    bgf = BetaGeoFitter(penalizer_coef=0.001)
-    bgf.fit(dataframe["frequency"], dataframe["recency_cltv_weekly"], dataframe["T_weekly"])
+    # kept float64: CLTV is built from differences of cumulative predictions, which lose precision in float32
+    frequency = dataframe["frequency"].to_numpy(np.float64)
+    recency = dataframe["recency_cltv_weekly"].to_numpy(np.float64)
+    T = dataframe["T_weekly"].to_numpy(np.float64)
+    monetary = dataframe["monetary_cltv_avg"].to_numpy(np.float64)
 
-    dataframe["exp_sales_3_month"] = bgf.predict(12, dataframe["frequency"], dataframe["recency_cltv_weekly"],
-                                                 dataframe["T_weekly"])
-    dataframe[f"exp_sales_{month}_month"] = bgf.predict(month * 4, dataframe["frequency"],
-                                                        dataframe["recency_cltv_weekly"],
-                                                        dataframe["T_weekly"])
+    bgf = BetaGeoFitter(penalizer_coef=0.001)
+    initial_params = _bgf_warm_start.get(bgf.penalizer_coef)
+    if initial_params is not None:
+        # lifetimes fits alpha on a time axis rescaled by 10 / T.max(), so move it onto this data's scale
+        initial_params = initial_params + np.log([1, 10.0 / T.max(), 1, 1])
+    bgf.fit(frequency, recency, T, initial_params=initial_params)
+    _bgf_warm_start[bgf.penalizer_coef] = np.log(bgf.params_.to_numpy())
+
+    weeks = np.array([12, month * 4], dtype=np.float64)[:, None]
+    expected_sales = bgf.conditional_expected_number_of_purchases_up_to_time(weeks, frequency[None, :],
+                                                                             recency[None, :], T[None, :])
+    dataframe["exp_sales_3_month"] = expected_sales[0]
+    dataframe[f"exp_sales_{month}_month"] = expected_sales[1]
 
     ggf = GammaGammaFitter(penalizer_coef=0.01)
-    ggf.fit(dataframe["frequency"], dataframe["monetary_cltv_avg"])
+    ggf.fit(frequency, monetary)
 
-    dataframe["exp_average_value"] = ggf.conditional_expected_average_profit(dataframe["frequency"])
+    dataframe["exp_average_value"] = ggf.conditional_expected_average_profit(frequency, monetary)
 
-    dataframe["cltv"] = ggf.customer_lifetime_value(bgf, dataframe["frequency"], dataframe["recency_cltv_weekly"],
-                                                    dataframe["T_weekly"], dataframe["monetary_cltv_avg"],
-                                                    time=month, freq="W", discount_rate=0.01)
+    dataframe["cltv"] = customer_lifetime_value(bgf, ggf, frequency, recency, T, monetary, time=month,
+                                                discount_rate=0.01)
 
     return dataframe
 
 
-def cltv_final(dataframe, segment_count, segments, csv=True):
+def cltv_final(dataframe, segment_count, segments, csv=True, parquet=False):
     """
-        Segments the customers based on CLTV and optionally saves the result to a CSV file.
+        Segments the customers based on CLTV and optionally saves the result to CSV and/or Parquet files.
 
         Parameters
         ----------
@@ -201,6 +242,8 @@ def cltv_final(dataframe, segment_count, segments, csv=True):
             List of labels for customer segments.
         csv : bool, optional
             Whether to save the result to a CSV file, default is True.
+        parquet : bool, optional
+            Whether to save the result to a zstd-compressed Parquet file, default is False.
 
         Returns
         -------
@@ -214,10 +257,32 @@ def cltv_final(dataframe, segment_count, segments, csv=True):
     if csv:
         dataframe.to_csv("cltv_flo.csv")
 
+    if parquet:
+        dataframe.to_parquet("cltv_flo.parquet", compression="zstd")
+
     return dataframe
 
 
-df_org = pd.read_csv("dataset/flo_data_20k.csv")
-df = df_org.copy()
+def load_data(path):
+    """
+    Reads the FLO dataset with pyarrow, parsing the date columns while the CSV is read.
+
+    Parameters
+    ----------
+    path : str
+        Path of the CSV file.
+
+    Returns
+    -------
+    pd.DataFrame
+        The raw DataFrame with datetime64 date columns.
+
+    """
+    date_types = {col: pa.timestamp("ns") for col in DATE_COLS}
+    convert_options = pacsv.ConvertOptions(column_types=date_types, timestamp_parsers=["%Y-%m-%d"])
+    return pacsv.read_csv(path, convert_options=convert_options).to_pandas()
+
+
+df = load_data("dataset/flo_data_20k.csv")
 
 cltv_final(df, 6, ["F", "D", "C", "B", "A", "S"])
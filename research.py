@@ -1,8 +1,10 @@
+import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 from lifetimes import BetaGeoFitter
 from lifetimes import GammaGammaFitter
 from lifetimes.plotting import plot_period_transactions
+from joblib import Memory
 import warnings
 
 warnings.filterwarnings("ignore")
@@ -10,6 +12,10 @@ pd.set_option("display.max_columns", None)
 pd.set_option('display.width', 500)
 pd.set_option('display.float_format', lambda x: '%.3f' % x)
 
+memory = Memory(".cache", verbose=0)
+
+DATE_COLS = ["first_order_date", "last_order_date", "last_order_date_online", "last_order_date_offline"]
+
 
 def dataset_summary(dataframe):
     """
@@ -65,16 +71,43 @@ def outlier_thresholds(dataframe, column, low_quantile=0.01, up_quantile=0.99):
 
 def check_outlier(dataframe, column):
     low_limit, up_limit = outlier_thresholds(dataframe, column)
-    if dataframe[(dataframe[column] > up_limit) | (dataframe[column] < low_limit)].any(axis=None):
-        return True
-    else:
-        return False
+    values = dataframe[column].to_numpy()
+    return bool(((values > up_limit) | (values < low_limit)).any())
 
 
 def replace_with_thresholds(dataframe, column):
     low_limit, up_limit = outlier_thresholds(dataframe, column)
-    dataframe.loc[(dataframe[column] < low_limit), column] = round(low_limit, 0)
-    dataframe.loc[(dataframe[column] > up_limit), column] = round(up_limit, 0)
+    dataframe[column] = np.clip(dataframe[column].to_numpy(), round(low_limit, 0), round(up_limit, 0))
+
+
+# only the fitted params are cached, a cache hit skips the fit and rebuilds the model from them
+@memory.cache
+def fit_bgf_params(frequency, recency, T, penalizer_coef):
+    model = BetaGeoFitter(penalizer_coef=penalizer_coef)
+    model.fit(frequency, recency, T)
+    return model.params_
+
+
+@memory.cache
+def fit_ggf_params(frequency, monetary_value, penalizer_coef):
+    model = GammaGammaFitter(penalizer_coef=penalizer_coef)
+    model.fit(frequency, monetary_value)
+    return model.params_
+
+
+# equivalent of pd.qcut on a column that has already been sorted once
+def qcut_sorted(values, sorted_values, labels):
+    # np.sort puts NaN at the end, quantiles are taken over the non-NaN part only
+    sorted_values = sorted_values[:np.count_nonzero(~np.isnan(sorted_values))]
+    positions = np.linspace(0, 1, len(labels) + 1) * (len(sorted_values) - 1)
+    lower = np.floor(positions).astype(int)
+    upper = np.minimum(lower + 1, len(sorted_values) - 1)
+    edges = sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (positions - lower)
+    if np.unique(edges).size < edges.size:
+        raise ValueError(f"Bin edges must be unique: {edges!r}.")
+    codes = np.searchsorted(edges[1:-1], values, side="left")
+    codes[np.isnan(values)] = -1
+    return pd.Categorical.from_codes(codes, labels, ordered=True)
 
 
 data_org = pd.read_csv("dataset/flo_data_20k.csv")
@@ -94,8 +127,7 @@ df["total_order_num"] = df["order_num_total_ever_online"] + df["order_num_total_
 df["customer_value_total"] = df["customer_value_total_ever_offline"] + df[
     "customer_value_total_ever_online"]
 
-date_cols = df.columns[df.columns.str.contains("date")]
-df[date_cols] = df[date_cols].apply(pd.to_datetime)
+df[DATE_COLS] = df[DATE_COLS].apply(pd.to_datetime, format="%Y-%m-%d")
 
 last_date = df["last_order_date"].max()
 
@@ -120,16 +152,18 @@ bgf = BetaGeoFitter(penalizer_coef=0.001)
 plot_period_transactions(bgf)
 plt.show()
 
-bgf.fit(cltv["frequency"], cltv["recency_cltv_weekly"], cltv["T_weekly"])
+bgf.params_ = fit_bgf_params(cltv["frequency"], cltv["recency_cltv_weekly"], cltv["T_weekly"], bgf.penalizer_coef)
+# lifetimes only binds predict inside fit(), the cached params skip it
+bgf.predict = bgf.conditional_expected_number_of_purchases_up_to_time
 
 cltv["exp_sales_3_month"] = bgf.predict(12, cltv["frequency"], cltv["recency_cltv_weekly"], cltv["T_weekly"])
 cltv["exp_sales_6_month"] = bgf.predict(24, cltv["frequency"], cltv["recency_cltv_weekly"], cltv["T_weekly"])
 
 ggf = GammaGammaFitter(penalizer_coef=0.01)
 
-ggf.fit(cltv["frequency"], cltv["monetary_cltv_avg"])
+ggf.params_ = fit_ggf_params(cltv["frequency"], cltv["monetary_cltv_avg"], ggf.penalizer_coef)
 
-cltv["exp_average_value"] = ggf.conditional_expected_average_profit(cltv["frequency"])
+cltv["exp_average_value"] = ggf.conditional_expected_average_profit(cltv["frequency"], cltv["monetary_cltv_avg"])
 
 # customer life time value for 6 months
 cltv["cltv"] = ggf.customer_lifetime_value(bgf, cltv["frequency"], cltv["recency_cltv_weekly"], cltv["T_weekly"],
@@ -137,7 +171,10 @@ cltv["cltv"] = ggf.customer_lifetime_value(bgf, cltv["frequency"], cltv["recency
 
 cltv.sort_values(by="cltv", ascending=False)[:10]
 
-cltv["segment"] = pd.qcut(cltv["cltv"], 4, ["D", "C", "B", "A"])
+cltv_values = cltv["cltv"].to_numpy()
+cltv_sorted = np.sort(cltv_values)
+
+cltv["segment"] = qcut_sorted(cltv_values, cltv_sorted, ["D", "C", "B", "A"])
 
 dataset_summary(cltv)
 
@@ -148,8 +185,8 @@ cltv.groupby("segment").agg({"cltv": ["mean", "max", "min"],
                              "exp_average_value": ["mean", "max", "min"]
                              })
 
-cltv["segment"] = pd.qcut(cltv["cltv"], 5, ["D", "C", "B", "A", "S"])
+cltv["segment"] = qcut_sorted(cltv_values, cltv_sorted, ["D", "C", "B", "A", "S"])
 
 # just 1 more too...
 
-cltv["segment"] = pd.qcut(cltv["cltv"], 6, ["F", "D", "C", "B", "A", "S"])
+cltv["segment"] = qcut_sorted(cltv_values, cltv_sorted, ["F", "D", "C", "B", "A", "S"])